@@ -24,10 +24,12 @@ INSTALL_REQUIRES = [
     "redis",
     "flask",
     "flask-pymongo",
+    "pymongo[zstd]",
     "prometheus-client",
     "pyyaml",
     "sentry-sdk[flask]",
     "apiflask",
+    "orjson",
 ]
 
 setup(
@@ -22,13 +22,15 @@ import os
 import urllib
 
 from flask import request
+from flask.json.provider import DefaultJSONProvider
 from flask.logging import create_logger
 from werkzeug.exceptions import NotFound
+from pymongo import ASCENDING
 from pymongo.errors import ConnectionFailure
 from apiflask import APIFlask
 
 from src.database import mongo
-from src.api.v1 import v1
+from src.api.v1 import v1, QUEUE_ORDER_INDEX
 from src.views import views
 
 # Constants for TTL indexes
@@ -41,10 +43,40 @@ try:
 except ImportError:
     pass
 
+try:
+    import orjson
+except ImportError:
+    pass
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that uses orjson for faster serialization
+
+    Like the default provider, keys are sorted and dates are formatted as
+    HTTP dates, so responses look the same to clients.
+    """
+
+    def dumps(self, obj, **kwargs):
+        """Serialize obj to a JSON string"""
+        option = (
+            orjson.OPT_SORT_KEYS
+            | orjson.OPT_NON_STR_KEYS
+            | orjson.OPT_PASSTHROUGH_DATETIME
+        )
+        return orjson.dumps(
+            obj, default=DefaultJSONProvider.default, option=option
+        ).decode()
+
+    def loads(self, s, **kwargs):
+        """Deserialize a JSON string or bytes"""
+        return orjson.loads(s)
+
 
 def create_flask_app(config=None):
     """Create the flask app"""
     tf_app = APIFlask(__name__)
+    if "orjson" in globals():
+        tf_app.json = OrjsonProvider(tf_app)
     if config:
         tf_app.config.from_object(config)
     tf_log = create_logger(tf_app)
@@ -103,6 +135,8 @@ def setup_mongodb(application):
     mongo_port = os.environ.get("MONGODB_PORT", "27017")
     mongo_uri = os.environ.get("MONGODB_URI")
     mongo_auth = os.environ.get("MONGODB_AUTH_SOURCE", "admin")
+    max_pool_size = int(os.environ.get("MONGODB_MAX_POOL_SIZE", "500"))
+    min_pool_size = int(os.environ.get("MONGODB_MIN_POOL_SIZE", "50"))
 
     if not mongo_uri:
         if not (mongo_host and mongo_db):
@@ -120,7 +154,13 @@ def setup_mongodb(application):
         uri=mongo_uri,
         uuidRepresentation="standard",
         serverSelectionTimeoutMS=2000,
+        connectTimeoutMS=2000,
         socketTimeoutMS=10000,
+        # Agents poll constantly, so keep plenty of connections open
+        maxPoolSize=max_pool_size,
+        minPoolSize=min_pool_size,
+        # job_data can be large, so compress traffic when the server allows
+        compressors="zstd,zlib",
     )
 
     # Initialize collections and indices in case they don't exist already
@@ -128,6 +168,10 @@ def setup_mongodb(application):
     mongo.db.jobs.create_index(
         "created_at", expireAfterSeconds=DEFAULT_EXPIRATION
     )
+    # Find the next job to run, and job positions, without scanning the queue
+    mongo.db.jobs.create_index(QUEUE_ORDER_INDEX)
+    # Not unique, resubmitted jobs keep their original job_id
+    mongo.db.jobs.create_index("job_id")
     # Remove output 4 hours after the last entry if nothing polls for it
     mongo.db.output.create_index(
         "updated_at", expireAfterSeconds=OUTPUT_EXPIRATION
@@ -139,3 +183,11 @@ def setup_mongodb(application):
     mongo.db.fs.files.create_index(
         "uploadDate", expireAfterSeconds=DEFAULT_EXPIRATION
     )
+    # Standard GridFS indexes, which GridFS.put would normally create but
+    # artifacts are written directly
+    mongo.db.fs.chunks.create_index(
+        [("files_id", ASCENDING), ("n", ASCENDING)], unique=True
+    )
+    mongo.db.fs.files.create_index(
+        [("filename", ASCENDING), ("uploadDate", ASCENDING)]
+    )
@@ -17,18 +17,29 @@
 Testflinger v1 API
 """
 
+import re
 import uuid
 from datetime import datetime
+from functools import lru_cache
+from importlib.metadata import PackageNotFoundError, version
 
-import pkg_resources
 from apiflask import APIBlueprint, abort
 from flask import jsonify, request, send_file
+from bson import Binary, ObjectId
 from gridfs import GridFS
 from gridfs.errors import NoFile
 from prometheus_client import Counter
+from pymongo import ASCENDING, UpdateOne
 from werkzeug.exceptions import BadRequest
 
-from src.database import mongo
+from src.database import (
+    job_id_from_db,
+    job_id_query,
+    job_id_to_db,
+    mongo,
+    queue_cache,
+    write_coalescer,
+)
 
 from . import schemas
 
@@ -38,6 +49,36 @@ reservations_metric = Counter(
 )
 
 
+# Fields to read back for each query. These are shared between requests, so
+# they must not be modified.
+JOB_DATA_PROJECTION = {"job_data": True, "_id": False}
+RESULT_DATA_PROJECTION = {"result_data": True, "_id": False}
+OUTPUT_PROJECTION = {"output": True, "_id": False}
+AGENTS_PROJECTION = {"log": False, "_id": False}
+JOB_POSITION_PROJECTION = {"created_at": True, "job_data.job_queue": True}
+NEXT_JOB_PROJECTION = {"job_id": True, "job_data": True, "_id": False}
+
+# Most output posts to keep for a job until something reads them
+OUTPUT_MAX_ENTRIES = 1000
+
+# Default GridFS chunk size, and enough chunks to fill a 16MB batch
+GRIDFS_CHUNK_SIZE = 255 * 1024
+GRIDFS_CHUNKS_PER_BATCH = 64
+
+# Jobs are handed out in submission order, with _id breaking ties between
+# jobs created in the same millisecond
+QUEUE_ORDER = [("created_at", ASCENDING), ("_id", ASCENDING)]
+# Index used to find the jobs waiting on a queue in submission order
+QUEUE_ORDER_INDEX = [
+    ("job_data.job_queue", ASCENDING),
+    ("result_data.job_state", ASCENDING),
+] + QUEUE_ORDER
+
+UUID_RE = re.compile(
+    r"\A[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-"
+    r"[0-9a-fA-F]{12}\Z"
+)
+
 v1 = APIBlueprint("v1", __name__)
 
 
@@ -47,13 +88,14 @@ def home():
     return get_version()
 
 
+@lru_cache(maxsize=1)
 def get_version():
     """Return the Testflinger version"""
     try:
-        version = pkg_resources.get_distribution("testflinger").version
-    except pkg_resources.DistributionNotFound:
-        version = "devel"
-    return "Testflinger Server v{}".format(version)
+        server_version = version("testflinger")
+    except PackageNotFoundError:
+        server_version = "devel"
+    return "Testflinger Server v{}".format(server_version)
 
 
 @v1.post("/job")
@@ -81,7 +123,7 @@ def job_post(json_data: dict):
     # CAUTION! If you ever move this line, you may need to pass data as a copy
     # because it will get modified by submit_job and other things it calls
     mongo.db.jobs.insert_one(job)
-    return jsonify(job_id=job.get("job_id"))
+    return jsonify(job_id=job_id_from_db(job.get("job_id")))
 
 
 def job_builder(data):
@@ -103,7 +145,7 @@ def job_builder(data):
         # This is a new job, so generate a new job_id
         job_id = str(uuid.uuid4())
 
-    job["job_id"] = job_id
+    job["job_id"] = job_id_to_db(job_id)
     job["job_data"] = data
     return job
 
@@ -137,7 +179,8 @@ def job_get_id(job_id):
     if not check_valid_uuid(job_id):
         abort(400, message="Invalid job_id specified")
     response = mongo.db.jobs.find_one(
-        {"job_id": job_id}, projection={"job_data": True, "_id": False}
+        {"job_id": job_id_query(job_id)},
+        projection=JOB_DATA_PROJECTION,
     )
     if not response:
         return {}, 204
@@ -158,10 +201,13 @@ def result_post(job_id, json_data):
         abort(400, message="Invalid job_id specified")
 
     # First, we need to prepend "result_data" to each key in the result_data
-    for key in list(json_data):
-        json_data[f"result_data.{key}"] = json_data.pop(key)
-
-    mongo.db.jobs.update_one({"job_id": job_id}, {"$set": json_data})
+    result_data = {
+        f"result_data.{key}": value for key, value in json_data.items()
+    }
+    write_coalescer.write(
+        mongo.db.jobs,
+        UpdateOne({"job_id": job_id_query(job_id)}, {"$set": result_data}),
+    )
     return "OK"
 
 
@@ -176,12 +222,11 @@ def result_get(job_id):
     if not check_valid_uuid(job_id):
         abort(400, message="Invalid job_id specified")
     response = mongo.db.jobs.find_one(
-        {"job_id": job_id}, {"result_data": True, "_id": False}
+        {"job_id": job_id_query(job_id)}, RESULT_DATA_PROJECTION
     )
 
     if not response or not (results := response.get("result_data")):
         return "", 204
-    results = response.get("result_data")
     return results
 
 
@@ -196,17 +241,73 @@ def artifacts_post(job_id):
         return "Invalid job id\n", 400
     file = request.files["file"]
     filename = f"{job_id}.artifact"
-    # Normally we would use flask-pymongo save_file but it doesn't seem to
-    # work nicely for me with mongomock
-    storage = GridFS(mongo.db)
-    file_id = storage.put(file, filename=filename)
+    store_artifact(file.stream, filename)
+    return "OK"
+
 
-    # Add a timestamp to the chunks - do this so we can set a TTL for them
-    timestamp = mongo.db.fs.files.find_one({"_id": file_id})["uploadDate"]
-    mongo.db.fs.chunks.update_many(
-        {"files_id": file_id}, {"$set": {"uploadDate": timestamp}}
+def store_artifact(stream, filename):
+    """Write a file to GridFS with the chunks timestamped as they are created
+
+    The chunks get an uploadDate, like the file itself, so that the TTL index
+    can expire them. They are inserted in batches rather than one at a time.
+
+    :param stream:
+        File-like object to read the artifact from
+    :param filename:
+        Name to store the artifact as
+    """
+    file_id = ObjectId()
+    timestamp = datetime.utcnow()
+    length = 0
+    chunk_number = 0
+    batch = []
+    while data := read_chunk(stream, GRIDFS_CHUNK_SIZE):
+        batch.append(
+            {
+                "files_id": file_id,
+                "n": chunk_number,
+                "data": Binary(data),
+                "uploadDate": timestamp,
+            }
+        )
+        length += len(data)
+        chunk_number += 1
+        if len(batch) == GRIDFS_CHUNKS_PER_BATCH:
+            mongo.db.fs.chunks.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        mongo.db.fs.chunks.insert_many(batch, ordered=False)
+    # Only add the file document once all chunks are written, so a partial
+    # upload is never visible to readers
+    mongo.db.fs.files.insert_one(
+        {
+            "_id": file_id,
+            "filename": filename,
+            "length": length,
+            "chunkSize": GRIDFS_CHUNK_SIZE,
+            "uploadDate": timestamp,
+        }
     )
-    return "OK"
+
+
+def read_chunk(stream, size):
+    """Read exactly size bytes from a stream, or fewer only at the end
+
+    GridFS treats any chunk but the last being short as a corrupt file, and
+    a single read() may return less than asked for.
+
+    :param stream:
+        File-like object to read from
+    :param size:
+        Number of bytes to read
+    """
+    data = stream.read(size)
+    while data and len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
 
 
 @v1.get("/result/<job_id>/artifact")
@@ -223,7 +324,7 @@ def artifacts_get(job_id):
     filename = f"{job_id}.artifact"
     # Normally we would use flask-pymongo send_file but it doesn't seem to
     # work nicely for me with mongomock
-    storage = GridFS(mongo.db)
+    storage = get_gridfs(mongo.db)
     try:
         file = storage.get_last_version(filename=filename)
     except NoFile:
@@ -231,6 +332,16 @@ def artifacts_get(job_id):
     return send_file(file, download_name="artifact.tar.gz")
 
 
+@lru_cache(maxsize=1)
+def get_gridfs(database):
+    """Return a GridFS store for the database, reusing it between requests
+
+    :param database:
+        pymongo Database holding the artifacts
+    """
+    return GridFS(database)
+
+
 @v1.get("/result/<job_id>/output")
 def output_get(job_id):
     """Get latest output for a specified job ID
@@ -242,8 +353,13 @@ def output_get(job_id):
     """
     if not check_valid_uuid(job_id):
         return "Invalid job id\n", 400
-    response = mongo.db.output.find_one_and_delete(
-        {"job_id": job_id}, {"_id": False}
+    # Empty the output rather than deleting the document, so posting more
+    # output doesn't need to insert it again. Only match when there is
+    # output waiting, so polling with nothing new doesn't write anything.
+    response = mongo.db.output.find_one_and_update(
+        {"job_id": job_id, "output.0": {"$exists": True}},
+        {"$set": {"output": []}},
+        projection=OUTPUT_PROJECTION,
     )
     output = response.get("output", []) if response else None
     if output:
@@ -263,11 +379,18 @@ def output_post(job_id):
     if not check_valid_uuid(job_id):
         abort(400, message="Invalid job_id specified")
     data = request.get_data().decode("utf-8")
-    timestamp = datetime.utcnow()
-    mongo.db.output.update_one(
-        {"job_id": job_id},
-        {"$set": {"updated_at": timestamp}, "$push": {"output": data}},
-        upsert=True,
+    write_coalescer.write(
+        mongo.db.output,
+        UpdateOne(
+            {"job_id": job_id},
+            {
+                "$currentDate": {"updated_at": True},
+                "$push": {
+                    "output": {"$each": [data], "$slice": -OUTPUT_MAX_ENTRIES}
+                },
+            },
+            upsert=True,
+        ),
     )
     return "OK"
 
@@ -301,14 +424,7 @@ def queues_get():
         "other_queue": "A queue for something else"
     }
     """
-    all_queues = mongo.db.queues.find(
-        {}, projection={"_id": False, "name": True, "description": True}
-    )
-    queue_dict = {}
-    # Create a dict of queues and descriptions
-    for queue in all_queues:
-        queue_dict[queue.get("name")] = queue.get("description", "")
-    return jsonify(queue_dict)
+    return jsonify(queue_cache.descriptions(mongo.db.queues))
 
 
 @v1.post("/agents/queues")
@@ -319,12 +435,17 @@ def queues_post():
     the user can check which queues are valid to use.
     """
     queue_dict = request.get_json()
-    for queue, description in queue_dict.items():
-        mongo.db.queues.update_one(
+    operations = [
+        UpdateOne(
             {"name": queue},
             {"$set": {"description": description}},
             upsert=True,
         )
+        for queue, description in queue_dict.items()
+    ]
+    if operations:
+        mongo.db.queues.bulk_write(operations, ordered=False)
+    queue_cache.clear()
     return "OK"
 
 
@@ -332,11 +453,8 @@ def queues_post():
 @v1.doc(responses=schemas.images_out)
 def images_get(queue):
     """Get a dict of known images for a given queue"""
-    queue_data = mongo.db.queues.find_one(
-        {"name": queue}, {"_id": False, "images": True}
-    )
     # It's ok for this to just return an empty result if there are none found
-    return jsonify(queue_data.get("images", {}))
+    return jsonify(queue_cache.images(mongo.db.queues, queue))
 
 
 @v1.post("/agents/images")
@@ -356,12 +474,17 @@ def images_post():
     """
     image_dict = request.get_json()
     # We need to delete and recreate the images in case some were removed
-    for queue, image_data in image_dict.items():
-        mongo.db.queues.update_one(
+    operations = [
+        UpdateOne(
             {"name": queue},
             {"$set": {"images": image_data}},
             upsert=True,
         )
+        for queue, image_data in image_dict.items()
+    ]
+    if operations:
+        mongo.db.queues.bulk_write(operations, ordered=False)
+    queue_cache.clear()
     return "OK"
 
 
@@ -369,7 +492,7 @@ def images_post():
 @v1.output(schemas.AgentOut)
 def agents_get_all():
     """Get all agent data"""
-    agents = mongo.db.agents.find({}, {"_id": False, "log": False})
+    agents = mongo.db.agents.find({}, AGENTS_PROJECTION)
     return jsonify(list(agents))
 
 
@@ -389,13 +512,16 @@ def agents_post(agent_name, json_data):
     """
 
     json_data["name"] = agent_name
-    json_data["updated_at"] = datetime.utcnow()
     # extract log from data so we can push it instead of setting it
     log = json_data.pop("log", [])
 
     mongo.db.agents.update_one(
         {"name": agent_name},
-        {"$set": json_data, "$push": {"log": {"$each": log, "$slice": -100}}},
+        {
+            "$set": json_data,
+            "$currentDate": {"updated_at": True},
+            "$push": {"log": {"$each": log, "$slice": -100}},
+        },
         upsert=True,
     )
     return "OK"
@@ -409,12 +535,7 @@ def check_valid_uuid(job_id):
     :return:
         True if job_id is valid, False if not
     """
-
-    try:
-        uuid.UUID(job_id)
-    except ValueError:
-        return False
-    return True
+    return UUID_RE.match(job_id) is not None
 
 
 def get_job(queue_list):
@@ -427,7 +548,9 @@ def get_job(queue_list):
                 "job_data.job_queue": {"$in": queue_list},
             },
             {"$set": {"result_data.job_state": "running"}},
-            projection={"job_id": True, "job_data": True, "_id": False},
+            projection=NEXT_JOB_PROJECTION,
+            sort=QUEUE_ORDER,
+            hint=QUEUE_ORDER_INDEX,
         )
     except TypeError:
         return None
@@ -435,32 +558,34 @@ def get_job(queue_list):
         return None
     # Flatten the job_data and include the job_id
     job = response.get("job_data")
-    job["job_id"] = response.get("job_id")
+    job["job_id"] = job_id_from_db(response.get("job_id"))
     return job
 
 
 @v1.get("/job/<job_id>/position")
 def job_position_get(job_id):
     """Return the position of the specified jobid in the queue"""
-    job_data, status = job_get_id(job_id)
-    if status == 204:
+    if not check_valid_uuid(job_id):
+        abort(400, message="Invalid job_id specified")
+    job = mongo.db.jobs.find_one(
+        {"job_id": job_id_query(job_id), "result_data.job_state": "waiting"},
+        JOB_POSITION_PROJECTION,
+    )
+    if not job:
         return "Job not found or already started\n", 410
-    if status != 200:
-        return job_data
-    try:
-        queue = job_data.json.get("job_queue")
-    except (AttributeError, TypeError):
-        return "Invalid json returned for id: {}\n".format(job_id), 400
-    # Get all jobs with job_queue=queue and return only the _id
-    jobs = mongo.db.jobs.find(
-        {"job_data.job_queue": queue, "result_data.job_state": "waiting"},
-        {"job_id": 1},
+    # Count the waiting jobs on the same queue that are ahead of this one
+    position = mongo.db.jobs.count_documents(
+        {
+            "job_data.job_queue": job["job_data"].get("job_queue"),
+            "result_data.job_state": "waiting",
+            "$or": [
+                {"created_at": {"$lt": job["created_at"]}},
+                {"created_at": job["created_at"], "_id": {"$lt": job["_id"]}},
+            ],
+        },
+        hint=QUEUE_ORDER_INDEX,
     )
-    # Create a dict mapping job_id (as a string) to the position in the queue
-    jobs_id_position = {job.get("job_id"): pos for pos, job in enumerate(jobs)}
-    if job_id in jobs_id_position:
-        return str(jobs_id_position[job_id])
-    return "Job not found or already started\n", 410
+    return str(position)
 
 
 def cancel_job(job_id):
@@ -472,7 +597,7 @@ def cancel_job(job_id):
     # Set the job status to cancelled
     response = mongo.db.jobs.update_one(
         {
-            "job_id": job_id,
+            "job_id": job_id_query(job_id),
             "result_data.job_state": {
                 "$nin": ["cancelled", "complete", "completed"]
             },
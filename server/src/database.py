@@ -17,6 +17,209 @@
 This returns a db object for talking to MongoDB
 """
 
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from bson import Binary
 from flask_pymongo import PyMongo
+from pymongo.errors import BulkWriteError, PyMongoError
 
 mongo = PyMongo()
+
+# Everything the queue cache reads about each queue
+QUEUES_PROJECTION = {
+    "_id": False,
+    "name": True,
+    "description": True,
+    "images": True,
+}
+
+
+def job_id_to_db(job_id):
+    """Convert a job_id string to the binary UUID stored in the jobs collection
+
+    This takes less than half the space of the string in the job_id index.
+
+    :param job_id:
+        UUID as a string for the job
+    """
+    return Binary.from_uuid(uuid.UUID(job_id))
+
+
+def job_id_from_db(job_id):
+    """Convert a job_id read from the jobs collection back to a string
+
+    :param job_id:
+        job_id as stored, either a binary UUID or a string
+    """
+    if isinstance(job_id, Binary):
+        job_id = job_id.as_uuid()
+    return str(job_id)
+
+
+def job_id_query(job_id):
+    """Return a query value matching a job_id in the jobs collection
+
+    Jobs stored before job_id became a binary UUID still have string IDs,
+    so match either form until those have expired.
+
+    :param job_id:
+        UUID as a string for the job
+    """
+    try:
+        return {"$in": [job_id_to_db(job_id), job_id]}
+    except ValueError:
+        return job_id
+
+
+class WriteCoalescer:  # pylint: disable=too-few-public-methods
+    """Coalesce concurrent writes into a single bulk_write per collection
+
+    Each caller queues its operation and then waits for the flush lock.
+    Whoever holds the lock drains everything queued so far, so requests
+    that arrive while a flush is in progress are written together in the
+    next round-trip. Callers only return once their own operation has been
+    written, so reads that follow a write still see it.
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def write(self, collection, operation):
+        """Write a pymongo operation to a collection, possibly batched
+
+        :param collection:
+            pymongo Collection the operation applies to
+        :param operation:
+            pymongo write operation such as UpdateOne
+        """
+        entry = {
+            "collection": collection,
+            "operation": operation,
+            "done": threading.Event(),
+        }
+        with self._pending_lock:
+            self._pending.append(entry)
+        with self._flush_lock:
+            if not entry["done"].is_set():
+                with self._pending_lock:
+                    if not any(item is entry for item in self._pending):
+                        # Another caller took it but never finished
+                        raise PyMongoError("Write was not confirmed")
+                    batch, self._pending = self._pending, []
+                self._flush(batch)
+        if "error" in entry:
+            raise entry["error"]
+
+    @staticmethod
+    def _flush(batch):
+        """Issue one unordered bulk_write for each collection in the batch"""
+        by_collection = defaultdict(list)
+        for entry in batch:
+            by_collection[entry["collection"].full_name].append(entry)
+        try:
+            for entries in by_collection.values():
+                WriteCoalescer._flush_collection(entries)
+        finally:
+            # If the flush was interrupted, e.g. by the greenlet being
+            # killed, fail every write that wasn't confirmed
+            for entry in batch:
+                if not entry["done"].is_set():
+                    entry["error"] = PyMongoError("Write was not confirmed")
+                    entry["done"].set()
+
+    @staticmethod
+    def _flush_collection(entries):
+        """Issue one unordered bulk_write for entries in the same collection"""
+        collection = entries[0]["collection"]
+        try:
+            collection.bulk_write(
+                [entry["operation"] for entry in entries], ordered=False
+            )
+        except BulkWriteError as error:
+            # Only fail the callers whose own operation was rejected
+            failed = {err["index"] for err in error.details["writeErrors"]}
+            for index, entry in enumerate(entries):
+                if index in failed or error.details["writeConcernErrors"]:
+                    entry["error"] = error
+        except Exception as error:  # pylint: disable=broad-except
+            for entry in entries:
+                entry["error"] = error
+        for entry in entries:
+            entry["done"].set()
+
+
+write_coalescer = WriteCoalescer()
+
+
+class QueueCache:
+    """Short-lived, process-local cache of the advertised queues
+
+    Queue descriptions and images only change when agents post them, but
+    they are read far more often. The whole queues collection is loaded in
+    one query, so every queue's images are ready before agents ask for them
+    and unknown queues are answered without a lookup. The copy expires after
+    ttl seconds so that changes posted to other server processes are picked
+    up, and is dropped immediately when this process sees a change.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._generation = 0
+        # (expiry time, descriptions, images) for all queues
+        self._snapshot = (0, None, None)
+
+    def descriptions(self, collection):
+        """Return a dict mapping every queue name to its description
+
+        :param collection:
+            pymongo Collection holding the queues
+        """
+        return self._load(collection)[0]
+
+    def images(self, collection, queue):
+        """Return the dict of images known for a queue
+
+        :param collection:
+            pymongo Collection holding the queues
+        :param queue:
+            Name of the queue
+        """
+        return self._load(collection)[1].get(queue, {})
+
+    def clear(self):
+        """Drop everything cached, e.g. after the queues have changed"""
+        with self._lock:
+            self._generation += 1
+            self._snapshot = (0, None, None)
+
+    def _load(self, collection):
+        """Return the cached descriptions and images, reloading if expired"""
+        with self._lock:
+            expires, descriptions, images = self._snapshot
+            generation = self._generation
+        if expires > time.monotonic():
+            return descriptions, images
+        all_queues = collection.find({}, projection=QUEUES_PROJECTION)
+        descriptions = {}
+        images = {}
+        for queue in all_queues:
+            descriptions[queue.get("name")] = queue.get("description", "")
+            images[queue.get("name")] = queue.get("images", {})
+        with self._lock:
+            # Don't keep data loaded from before the cache was cleared
+            if generation == self._generation:
+                self._snapshot = (
+                    time.monotonic() + self.ttl,
+                    descriptions,
+                    images,
+                )
+        return descriptions, images
+
+
+queue_cache = QueueCache()
@@ -19,7 +19,7 @@ Additional views not associated with the API
 
 from flask import Blueprint, render_template, redirect, url_for
 from prometheus_client import generate_latest
-from src.database import mongo
+from src.database import job_id_query, mongo
 
 views = Blueprint("testflinger", __name__)
 
@@ -60,7 +60,7 @@ def jobs():
 @views.route("/jobs/<job_id>")
 def job_detail(job_id):
     """Job detail view"""
-    job_data = mongo.db.jobs.find_one({"job_id": job_id})
+    job_data = mongo.db.jobs.find_one({"job_id": job_id_query(job_id)})
     return render_template("job_detail.html", job=job_data)
 
 
@@ -23,6 +23,7 @@ import mongomock
 from mongomock.gridfs import enable_gridfs_integration
 import src
 from src.api import v1
+from src.database import queue_cache
 
 
 @dataclass
@@ -44,10 +45,38 @@ class MongoClientMock(mongomock.MongoClient):
         return super().start_session(*args, **kwargs)
 
 
+def sorted_find_one_and_update(original):
+    """Wrap mongomock's find_one_and_update so sort picks the updated doc
+
+    When the projection leaves out _id, mongomock returns the first document
+    in sort order but updates the first match in insertion order. Resolve
+    the sorted match to its _id first, as MongoDB itself would.
+    """
+
+    def find_one_and_update(self, filter, update, *args, sort=None, **kw):
+        # pylint: disable=redefined-builtin
+        if sort:
+            target = self.find_one(filter, {"_id": True}, sort=sort)
+            if target:
+                filter = {"_id": target["_id"]}
+        return original(self, filter, update, *args, sort=sort, **kw)
+
+    return find_one_and_update
+
+
 @pytest.fixture
-def mongo_app():
+def mongo_app(monkeypatch):
     """Create a pytest fixture for the app"""
+    monkeypatch.setattr(
+        mongomock.collection.Collection,
+        "find_one_and_update",
+        sorted_find_one_and_update(
+            mongomock.collection.Collection.find_one_and_update
+        ),
+    )
     mock_mongo = MongoClientMock()
+    queue_cache.clear()
+    v1.get_gridfs.cache_clear()
 
     app = src.create_flask_app(TestingConfig)
     old_src_mongo = src.mongo
@@ -17,6 +17,8 @@
 Unit tests for Testflinger flask app
 """
 
+from datetime import datetime
+
 import pytest
 import src
 
@@ -32,3 +34,38 @@ def test_setup_mongo_fails_without_config():
     with pytest.raises(SystemExit) as exc:
         src.create_flask_app()
     assert exc.value.code == "No MongoDB URI configured!"
+
+
+def test_setup_mongodb_pool_size(mocker, monkeypatch):
+    """Ensure the connection pool size can be configured"""
+    mock_mongo = mocker.patch("src.mongo")
+    monkeypatch.setenv("MONGODB_URI", "mongodb://localhost/testflinger_db")
+    monkeypatch.setenv("MONGODB_MAX_POOL_SIZE", "20")
+    src.setup_mongodb(mocker.Mock())
+    kwargs = mock_mongo.init_app.call_args.kwargs
+    assert kwargs["maxPoolSize"] == 20
+    assert kwargs["minPoolSize"] == 50
+
+
+def test_json_provider(testing_app):
+    """Test that JSON output matches the default provider's format"""
+    json_provider = testing_app.json
+    assert isinstance(json_provider, src.OrjsonProvider)
+    data = {"b": 1, "a": datetime(2023, 1, 2, 3, 4, 5)}
+    assert json_provider.dumps(data) == (
+        '{"a":"Mon, 02 Jan 2023 03:04:05 GMT","b":1}'
+    )
+    assert json_provider.loads('{"a": [1, 2]}') == {"a": [1, 2]}
+
+
+def test_setup_mongodb_gridfs_indexes(mocker, monkeypatch):
+    """Ensure the standard GridFS indexes are created for artifacts"""
+    mock_mongo = mocker.patch("src.mongo")
+    monkeypatch.setenv("MONGODB_URI", "mongodb://localhost/testflinger_db")
+    src.setup_mongodb(mocker.Mock())
+    mock_mongo.db.fs.chunks.create_index.assert_any_call(
+        [("files_id", 1), ("n", 1)], unique=True
+    )
+    mock_mongo.db.fs.files.create_index.assert_any_call(
+        [("filename", 1), ("uploadDate", 1)]
+    )
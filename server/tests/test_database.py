@@ -0,0 +1,189 @@
+# Copyright (C) 2016-2022 Canonical
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Unit tests for Testflinger database helpers
+"""
+
+import threading
+
+import mongomock
+import pytest
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from src.database import QueueCache, WriteCoalescer, job_id_query
+
+
+class FakeCollection:  # pylint: disable=too-few-public-methods
+    """Collection that records bulk_write calls"""
+
+    full_name = "db.output"
+
+    def __init__(self, write_errors=None, interrupt=None):
+        self.write_errors = write_errors
+        self.interrupt = interrupt
+        self.calls = []
+        self.flushing = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def bulk_write(self, operations, ordered=True):
+        """Record the batch, optionally blocking until released"""
+        self.calls.append((operations, ordered))
+        if self.interrupt:
+            raise self.interrupt
+        if self.write_errors:
+            raise BulkWriteError(
+                {"writeErrors": self.write_errors, "writeConcernErrors": []}
+            )
+        self.flushing.set()
+        self.release.wait(5)
+
+
+def test_write_coalescer_single_write():
+    """A lone write is flushed straight away"""
+    collection = FakeCollection()
+    operation = UpdateOne({"job_id": "1"}, {"$set": {"a": 1}})
+    WriteCoalescer().write(collection, operation)
+    assert collection.calls == [([operation], False)]
+
+
+def test_write_coalescer_batches_pending_writes():
+    """Writes queued during a flush are sent together in one bulk_write"""
+    coalescer = WriteCoalescer()
+    collection = FakeCollection()
+    collection.release.clear()
+    first = UpdateOne({"job_id": "1"}, {"$set": {"a": 1}})
+    first_thread = threading.Thread(
+        target=coalescer.write, args=(collection, first)
+    )
+    first_thread.start()
+    collection.flushing.wait(5)
+
+    waiting = [
+        UpdateOne({"job_id": str(i)}, {"$set": {"a": i}}) for i in (2, 3)
+    ]
+    threads = [
+        threading.Thread(target=coalescer.write, args=(collection, op))
+        for op in waiting
+    ]
+    for thread in threads:
+        thread.start()
+    # Wait for both writes to be queued behind the first flush
+    while len(coalescer._pending) < 2:  # pylint: disable=protected-access
+        threading.Event().wait(0.01)
+    collection.release.set()
+    for thread in [first_thread] + threads:
+        thread.join(5)
+
+    assert len(collection.calls) == 2
+    assert collection.calls[0][0] == [first]
+    assert sorted(collection.calls[1][0], key=str) == sorted(waiting, key=str)
+
+
+def test_write_coalescer_raises_only_for_failed_write():
+    """A rejected operation raises for its caller only"""
+    collection = FakeCollection(write_errors=[{"index": 1, "errmsg": "bad"}])
+    coalescer = WriteCoalescer()
+    good = {"collection": collection, "operation": None}
+    bad = {"collection": collection, "operation": None}
+    good["done"] = threading.Event()
+    bad["done"] = threading.Event()
+    coalescer._flush([good, bad])  # pylint: disable=protected-access
+    assert "error" not in good
+    assert isinstance(bad["error"], BulkWriteError)
+    assert good["done"].is_set() and bad["done"].is_set()
+
+
+class Interrupted(BaseException):
+    """Stands in for gevent's GreenletExit or Timeout"""
+
+
+def test_write_coalescer_interrupted_flush():
+    """Writes in a batch that was interrupted are failed, not lost"""
+    collection = FakeCollection(interrupt=Interrupted())
+    coalescer = WriteCoalescer()
+    first = {"collection": collection, "operation": None}
+    second = {"collection": collection, "operation": None}
+    first["done"] = threading.Event()
+    second["done"] = threading.Event()
+    with pytest.raises(Interrupted):
+        coalescer._flush([first, second])  # pylint: disable=protected-access
+    for entry in (first, second):
+        assert entry["done"].is_set()
+        assert isinstance(entry["error"], PyMongoError)
+
+
+class DrainedList(list):
+    """List that drops anything appended to it"""
+
+    def append(self, item):
+        pass
+
+
+def test_write_coalescer_taken_but_unfinished():
+    """A write taken by a flush that never finished is not reported OK"""
+    collection = FakeCollection()
+    coalescer = WriteCoalescer()
+    # Simulate another caller draining the entry as soon as it is queued
+    # and then dying before it was written
+    coalescer._pending = DrainedList()  # pylint: disable=protected-access
+    with pytest.raises(PyMongoError):
+        coalescer.write(collection, None)
+    assert not collection.calls
+
+
+def test_queue_cache_serves_from_memory():
+    """Cached queue data is returned until the cache is cleared"""
+    queues = mongomock.MongoClient().db.queues
+    queues.insert_one({"name": "q1", "description": "one", "images": {"a": 1}})
+    cache = QueueCache()
+    assert cache.descriptions(queues) == {"q1": "one"}
+    assert cache.images(queues, "q1") == {"a": 1}
+
+    queues.update_one({"name": "q1"}, {"$set": {"description": "changed"}})
+    assert cache.descriptions(queues) == {"q1": "one"}
+    cache.clear()
+    assert cache.descriptions(queues) == {"q1": "changed"}
+
+
+def test_queue_cache_expires():
+    """Entries are reloaded once the ttl has passed"""
+    queues = mongomock.MongoClient().db.queues
+    queues.insert_one({"name": "q1", "images": {"a": 1}})
+    cache = QueueCache(ttl=0)
+    assert cache.images(queues, "q1") == {"a": 1}
+    queues.update_one({"name": "q1"}, {"$set": {"images": {"b": 2}}})
+    assert cache.images(queues, "q1") == {"b": 2}
+
+
+def test_queue_cache_loads_all_queues_at_once():
+    """One query fills the cache for every queue, including unknown ones"""
+    queues = mongomock.MongoClient().db.queues
+    queues.insert_one({"name": "q1", "images": {"a": 1}})
+    queues.insert_one({"name": "q2", "images": {"b": 2}})
+    cache = QueueCache()
+    assert cache.images(queues, "q1") == {"a": 1}
+
+    queues.delete_many({})
+    assert cache.images(queues, "q2") == {"b": 2}
+    assert cache.images(queues, "missing") == {}
+    assert cache.descriptions(queues) == {"q1": "", "q2": ""}
+
+
+def test_job_id_query_invalid_uuid():
+    """A job_id that isn't a UUID can only match as a string"""
+    assert job_id_query("not-a-uuid") == "not-a-uuid"
@@ -19,8 +19,10 @@ Unit tests for Testflinger v1 API
 
 import json
 
+from datetime import datetime
 from io import BytesIO
 from src.api import v1
+from src.database import job_id_from_db, job_id_to_db
 
 
 def test_home(mongo_app):
@@ -31,6 +33,14 @@ def test_home(mongo_app):
     assert "/agents" == response.headers.get("Location")
 
 
+def test_v1_home(mongo_app):
+    """Test that the v1 API identifies itself with the server version"""
+    app, _ = mongo_app
+    response = app.get("/v1/")
+    assert response.text == v1.get_version()
+    assert response.text.startswith("Testflinger Server v")
+
+
 def test_add_job_good(mongo_app):
     """Test that adding a new job works"""
     job_data = {"job_queue": "test"}
@@ -85,6 +95,45 @@ def test_resubmit_job_state(mongo_app):
     assert "waiting" == updated_data.get("job_state")
 
 
+def test_get_job_oldest_first(mongo_app):
+    """Test that the job submitted first is handed out first"""
+    app, mongo = mongo_app
+    output = app.post("/v1/job", json={"job_queue": "test"})
+    newer_job_id = output.json.get("job_id")
+    # Insert a job that was created earlier, after the newer job
+    older_job = v1.job_builder({"job_queue": "test"})
+    older_job["created_at"] = datetime(2020, 1, 1)
+    mongo.jobs.insert_one(older_job)
+
+    output = app.get("/v1/job?queue=test")
+    assert output.json.get("job_id") == job_id_from_db(older_job["job_id"])
+    output = app.get("/v1/job?queue=test")
+    assert output.json.get("job_id") == newer_job_id
+
+
+def test_job_id_stored_as_binary_uuid(mongo_app):
+    """Test that job IDs are stored in binary form but returned as strings"""
+    app, mongo = mongo_app
+    output = app.post("/v1/job", json={"job_queue": "test"})
+    job_id = output.json.get("job_id")
+    job = mongo.jobs.find_one({"job_id": job_id_to_db(job_id)})
+    assert job_id_from_db(job["job_id"]) == job_id
+    assert mongo.jobs.find_one({"job_id": job_id}) is None
+    assert app.get("/v1/job?queue=test").json.get("job_id") == job_id
+
+
+def test_legacy_string_job_id(mongo_app):
+    """Test that jobs stored with a string job_id can still be found"""
+    app, mongo = mongo_app
+    job = v1.job_builder({"job_queue": "test"})
+    job_id = job_id_from_db(job["job_id"])
+    job["job_id"] = job_id
+    mongo.jobs.insert_one(job)
+    assert app.get(f"/v1/result/{job_id}").json == {"job_state": "waiting"}
+    assert app.get(f"/v1/job/{job_id}/position").text == "0"
+    assert app.get("/v1/job?queue=test").json.get("job_id") == job_id
+
+
 def test_get_nonexistant_job(mongo_app):
     """Test for 204 when getting from a nonexistent queue"""
     app, _ = mongo_app
@@ -130,6 +179,16 @@ def test_add_job_empty_queue(mongo_app):
     assert 422 == output.status_code
 
 
+def test_check_valid_uuid():
+    """Only canonical hyphenated UUIDs are accepted as job IDs"""
+    assert v1.check_valid_uuid("77777777-7777-7777-7777-777777777777")
+    assert v1.check_valid_uuid("ABCDEF01-2345-6789-abcd-ef0123456789")
+    assert not v1.check_valid_uuid("77777777777777777777777777777777")
+    assert not v1.check_valid_uuid("77777777-7777-7777-7777-777777777777\n")
+    assert not v1.check_valid_uuid("{77777777-7777-7777-7777-777777777777}")
+    assert not v1.check_valid_uuid("BAD_JOB_ID")
+
+
 def test_result_get_result_not_exists(mongo_app):
     """Test for 204 when getting a nonexistent result"""
     app, _ = mongo_app
@@ -206,6 +265,49 @@ def test_artifact_post_good(mongo_app):
     assert output.data == data
 
 
+def test_artifact_post_multiple_chunks(mongo_app, monkeypatch):
+    """Test an artifact spread over several chunk batches reads back whole"""
+    app, mongo = mongo_app
+    monkeypatch.setattr(v1, "GRIDFS_CHUNK_SIZE", 4)
+    monkeypatch.setattr(v1, "GRIDFS_CHUNKS_PER_BATCH", 2)
+    job_id = "00000000-0000-0000-0000-000000000000"
+    artifact_url = f"/v1/result/{job_id}/artifact"
+    data = b"test file content spanning several chunks"
+    filedata = {"file": (BytesIO(data), "artifact.tgz")}
+    output = app.post(
+        artifact_url, data=filedata, content_type="multipart/form-data"
+    )
+    assert "OK" == output.text
+    # Every chunk should be timestamped so the TTL index can expire it
+    chunks = list(mongo.fs.chunks.find())
+    assert len(chunks) == 11
+    assert all("uploadDate" in chunk for chunk in chunks)
+    output = app.get(artifact_url)
+    assert output.data == data
+
+
+def test_get_gridfs_reused(mongo_app):
+    """Test that the GridFS store is only created once per database"""
+    _, mongo = mongo_app
+    assert v1.get_gridfs(mongo) is v1.get_gridfs(mongo)
+
+
+def test_read_chunk_short_reads():
+    """Test that chunks are filled even when the stream returns short reads"""
+
+    class TrickleStream(BytesIO):
+        """Stream that never returns more than 3 bytes per read"""
+
+        def read(self, size=-1):
+            return super().read(min(size, 3))
+
+    stream = TrickleStream(b"0123456789")
+    assert v1.read_chunk(stream, 4) == b"0123"
+    assert v1.read_chunk(stream, 4) == b"4567"
+    assert v1.read_chunk(stream, 4) == b"89"
+    assert v1.read_chunk(stream, 4) == b""
+
+
 def test_result_get_artifact_not_exists(mongo_app):
     """Get artifacts for a nonexistent job and confirm we get 204"""
     app, _ = mongo_app
@@ -226,6 +328,45 @@ def test_output_post_get(mongo_app):
     assert output.text == data
 
 
+def test_output_get_drains_output(mongo_app):
+    """Test that output is only returned once, and more can be posted"""
+    app, _ = mongo_app
+    output_url = "/v1/result/00000000-0000-0000-0000-000000000000/output"
+    app.post(output_url, data="line1")
+    assert app.get(output_url).text == "line1"
+    assert 204 == app.get(output_url).status_code
+    app.post(output_url, data="line2")
+    assert app.get(output_url).text == "line2"
+
+
+def test_output_get_multiple_posts(mongo_app):
+    """Test that output from several posts is returned in order"""
+    app, _ = mongo_app
+    output_url = "/v1/result/00000000-0000-0000-0000-000000000000/output"
+    for data in ("line1", "line2\nline3", "line4"):
+        app.post(output_url, data=data)
+    assert app.get(output_url).text == "line1\nline2\nline3\nline4"
+
+
+def test_output_post_timestamp(mongo_app):
+    """Test that posting output records when it was last updated"""
+    app, mongo = mongo_app
+    job_id = "00000000-0000-0000-0000-000000000000"
+    app.post(f"/v1/result/{job_id}/output", data="line1")
+    output = mongo.output.find_one({"job_id": job_id})
+    assert isinstance(output["updated_at"], datetime)
+
+
+def test_output_post_capped(mongo_app, monkeypatch):
+    """Test that only the most recent output posts are kept"""
+    app, _ = mongo_app
+    monkeypatch.setattr(v1, "OUTPUT_MAX_ENTRIES", 3)
+    output_url = "/v1/result/00000000-0000-0000-0000-000000000000/output"
+    for line in range(5):
+        app.post(output_url, data=f"line{line}")
+    assert app.get(output_url).text == "line2\nline3\nline4"
+
+
 def test_job_get_result_invalid(mongo_app):
     """Test getting results with bad job UUID fails"""
     app, _ = mongo_app
@@ -286,6 +427,31 @@ def test_job_position(mongo_app):
     assert app.get("/v1/job/{}/position".format(job_id[2])).text == "0"
 
 
+def test_job_position_not_found(mongo_app):
+    """Test that the position of an unknown job is reported as gone"""
+    app, _ = mongo_app
+    output = app.get("/v1/job/00000000-0000-0000-0000-000000000000/position")
+    assert 410 == output.status_code
+
+
+def test_job_position_started_job(mongo_app):
+    """Test that a job which has already started has no queue position"""
+    app, _ = mongo_app
+    output = app.post("/v1/job", json={"job_queue": "test"})
+    job_id = output.json.get("job_id")
+    app.get("/v1/job?queue=test")
+    output = app.get(f"/v1/job/{job_id}/position")
+    assert 410 == output.status_code
+    assert "Job not found or already started" in output.text
+
+
+def test_job_position_bad_job_id(mongo_app):
+    """Test that asking for the position of a bad job ID fails"""
+    app, _ = mongo_app
+    output = app.get("/v1/job/BAD_JOB_ID/position")
+    assert 400 == output.status_code
+
+
 def test_action_post(mongo_app):
     """Test getting 422 code for an unsupported action"""
     app, _ = mongo_app
@@ -318,6 +484,33 @@ def test_images_post(mongo_app):
     assert json.loads(output.data.decode()) == image_data.get("myqueue")
 
 
+def test_queues_post_multiple(mongo_app):
+    """Test posting several queues at once, and posting none"""
+    app, _ = mongo_app
+    queue_data = {"qfoo": "foo queue", "qbar": "bar queue", "qbaz": ""}
+    assert "OK" == app.post("/v1/agents/queues", json=queue_data).text
+    assert "OK" == app.post("/v1/agents/queues", json={}).text
+    output = app.get("/v1/agents/queues")
+    assert output.json == queue_data
+
+
+def test_queues_post_updates_cached_queues(mongo_app):
+    """Test that posting queues again replaces what was already served"""
+    app, _ = mongo_app
+    app.post("/v1/agents/queues", json={"qfoo": "old description"})
+    assert app.get("/v1/agents/queues").json == {"qfoo": "old description"}
+    app.post("/v1/agents/queues", json={"qfoo": "new description"})
+    assert app.get("/v1/agents/queues").json == {"qfoo": "new description"}
+
+
+def test_images_get_unknown_queue(mongo_app):
+    """Test that a queue without images returns an empty dict"""
+    app, _ = mongo_app
+    output = app.get("/v1/agents/images/nosuchqueue")
+    assert 200 == output.status_code
+    assert output.json == {}
+
+
 def test_get_invalid(mongo_app):
     """Get a nonexistent URL and confirm we get 404"""
     app, _ = mongo_app
@@ -353,14 +546,14 @@ def test_cancel_job_good(mongo_app):
     job_id = job_output.json.get("job_id")
 
     # Make sure the job exists
-    job = mongo.jobs.find_one({"job_id": job_id})
+    job = mongo.jobs.find_one({"job_id": job_id_to_db(job_id)})
     assert job is not None
     assert job["result_data"]["job_state"] == "waiting"
 
     # Cancel the job
     output = app.post(f"/v1/job/{job_id}/action", json={"action": "cancel"})
     assert "OK" == output.text
-    job = mongo.jobs.find_one({"job_id": job_id})
+    job = mongo.jobs.find_one({"job_id": job_id_to_db(job_id)})
     assert job["result_data"]["job_state"] == "cancelled"
 
 
@@ -383,6 +576,7 @@ def test_agents_post(mongo_app):
     # Test that the expected data was stored
     agent_record = mongo.agents.find_one({"name": agent_name})
     assert agent_data.items() <= agent_record.items()
+    assert isinstance(agent_record["updated_at"], datetime)
 
     # Update the agent data again
     output = app.post(f"/v1/agents/data/{agent_name}", json=agent_data)
@@ -421,3 +615,25 @@ def test_get_agents_data(mongo_app):
     assert len(output.json) == 1
     for key, value in agent_data.items():
         assert output.json[0][key] == value
+
+
+def test_get_agents_data_empty(mongo_app):
+    """Test that retrieving agent data with no agents returns an empty list"""
+    app, _ = mongo_app
+    output = app.get("/v1/agents/data")
+    assert 200 == output.status_code
+    assert output.json == []
+
+
+def test_get_agents_data_multiple(mongo_app):
+    """Test that all agents are returned in one JSON list"""
+    app, _ = mongo_app
+    for agent_name in ("agent1", "agent2", "agent3"):
+        app.post(f"/v1/agents/data/{agent_name}", json={"state": "waiting"})
+    output = app.get("/v1/agents/data")
+    assert 200 == output.status_code
+    assert sorted(agent["name"] for agent in output.json) == [
+        "agent1",
+        "agent2",
+        "agent3",
+    ]